@@ -1,13 +1,17 @@
 import os
 import streamlit as st
 import pandas as pd
+import pyarrow as pa
 import folium
+from folium.plugins import MarkerCluster
+from folium.utilities import JsCode
 from streamlit_folium import st_folium
-from pymongo import MongoClient
+from pymongo import MongoClient, ReturnDocument
 import certifi
 from dotenv import load_dotenv
 from bson.objectid import ObjectId
 import datetime
+import uuid
 from export import export_data_for_training
 
 st.set_page_config(page_title="Pothole Dashboard", page_icon="📡", layout="wide")
@@ -31,31 +35,150 @@ def init_connection():
 db = init_connection()
 potholes_collection = db.potholes if db is not None else None
 
+# Only the fields the dashboard actually renders are sent over the wire.
+POTHOLE_PROJECTION = {
+    "location.coordinates": 1, "severity": 1, "timestamp": 1,
+    "image_url": 1, "status": 1, "reject_reason": 1,
+}
+
+# The data log shows the most recent potholes of any status and the map the
+# most recent confirmed ones; the summary metrics are computed by MongoDB
+# over every confirmed pothole. All three are served by the
+# (status, timestamp) / timestamp indexes created in main.py.
+RECENT_LIMIT = 1000
+CONFIRMED_LIMIT = 5000
+# Documents per server round-trip while streaming the cursors.
+CURSOR_BATCH_SIZE = 500
+# A review claim older than this is treated as abandoned and can be taken again.
+REVIEW_TIMEOUT = datetime.timedelta(minutes=15)
+
+EMPTY_SUMMARY = {"total_confirmed": 0, "most_common_severity": "N/A", "centroid": None}
+
+SUMMARY_PIPELINE = [
+    {"$match": {"status": "confirmed"}},
+    {"$facet": {
+        "severity_counts": [
+            {"$group": {"_id": "$severity", "n": {"$sum": 1}}},
+            # Tie-break on severity so the metric is stable, like pandas mode()[0].
+            {"$sort": {"n": -1, "_id": 1}},
+        ],
+        "centroid": [
+            {"$group": {
+                "_id": None,
+                "lon": {"$avg": {"$arrayElemAt": ["$location.coordinates", 0]}},
+                "lat": {"$avg": {"$arrayElemAt": ["$location.coordinates", 1]}},
+            }},
+        ],
+    }},
+]
+
+# Columns are held in Arrow buffers rather than as Python objects, which keeps
+# the string-heavy log small and fast to sort, filter and hand to st.dataframe.
+POTHOLE_SCHEMA = pa.schema([
+    ("_id", pa.string()),
+    ("severity", pa.string()),
+    ("timestamp", pa.timestamp("ms")),
+    ("image_url", pa.string()),
+    ("status", pa.string()),
+    ("reject_reason", pa.string()),
+    ("longitude", pa.float64()),
+    ("latitude", pa.float64()),
+])
+
+def docs_to_frame(docs):
+    """
+    Builds one list per column in a single pass over the documents, then
+    converts them straight into an Arrow-backed DataFrame.
+    """
+    cols = {name: [] for name in POTHOLE_SCHEMA.names}
+    for doc in docs:
+        cols["_id"].append(str(doc["_id"]))
+        cols["severity"].append(doc.get("severity"))
+        cols["timestamp"].append(doc.get("timestamp"))
+        cols["image_url"].append(doc.get("image_url"))
+        cols["status"].append(doc.get("status"))
+        cols["reject_reason"].append(doc.get("reject_reason"))
+        coords = (doc.get("location") or {}).get("coordinates") or (None, None)
+        cols["longitude"].append(coords[0])
+        cols["latitude"].append(coords[1])
+    return pa.Table.from_pydict(cols, schema=POTHOLE_SCHEMA).to_pandas(types_mapper=pd.ArrowDtype)
+
 @st.cache_data(ttl=600)
 def get_data_from_db():
+    """Returns (recent potholes DataFrame, confirmed potholes DataFrame, summary dict)."""
     if potholes_collection is None:
-        return pd.DataFrame()
+        return pd.DataFrame(), pd.DataFrame(), EMPTY_SUMMARY
 
     try:
-        potholes = list(potholes_collection.find().sort("timestamp", -1))
-        
-        if not potholes:
-            return pd.DataFrame()
+        summary = dict(EMPTY_SUMMARY)
+        facets = next(potholes_collection.aggregate(SUMMARY_PIPELINE), None)
+        if facets:
+            severity_counts = facets["severity_counts"]
+            if severity_counts:
+                summary["total_confirmed"] = sum(c["n"] for c in severity_counts)
+                summary["most_common_severity"] = severity_counts[0]["_id"]
+            if facets["centroid"]:
+                centroid = facets["centroid"][0]
+                summary["centroid"] = [centroid["lat"], centroid["lon"]]
 
-        df = pd.DataFrame(potholes)
-        
-        if '_id' in df.columns:
-            df['_id'] = df['_id'].astype(str)
+        recent = (potholes_collection.find({}, POTHOLE_PROJECTION)
+                  .sort("timestamp", -1).limit(RECENT_LIMIT).batch_size(CURSOR_BATCH_SIZE))
+        df = docs_to_frame(recent)
+        if df.empty:
+            return pd.DataFrame(), pd.DataFrame(), summary
 
-        if 'location' in df.columns:
-            df['longitude'] = df['location'].apply(lambda x: x['coordinates'][0] if x else None)
-            df['latitude'] = df['location'].apply(lambda x: x['coordinates'][1] if x else None)
+        confirmed = (potholes_collection.find({"status": "confirmed"}, POTHOLE_PROJECTION)
+                     .sort("timestamp", -1).limit(CONFIRMED_LIMIT).batch_size(CURSOR_BATCH_SIZE))
         
-        return df
+        return df, docs_to_frame(confirmed), summary
         
     except Exception as e:
         st.error(f"Error fetching data: {e}")
-        return pd.DataFrame()
+        return pd.DataFrame(), pd.DataFrame(), EMPTY_SUMMARY
+
+def get_review_token():
+    """
+    Identifies this reviewer's claims. Kept in the page URL so a browser reload
+    resumes the same claim instead of starting a new one.
+    """
+    token = st.query_params.get("reviewer")
+    if not token:
+        token = uuid.uuid4().hex
+        st.query_params["reviewer"] = token
+    return token
+
+def claimable_filter(now):
+    """Unverified potholes, plus claims older than REVIEW_TIMEOUT (treated as abandoned)."""
+    return {"$or": [
+        {"status": "unverified"},
+        {"status": "in_review", "reserved_at": {"$lt": now - REVIEW_TIMEOUT}},
+    ]}
+
+def get_reserved_pothole(token):
+    """Returns the pothole this reviewer currently holds, or None."""
+    return potholes_collection.find_one({"status": "in_review", "reserved_by": token})
+
+def claim_next_pothole(token):
+    """
+    Atomically claims one pothole for this reviewer, so two open dashboards
+    never verify the same one. Returns the claimed document, or None if
+    nothing was left to claim.
+    """
+    now = datetime.datetime.now(datetime.UTC)
+    return potholes_collection.find_one_and_update(
+        claimable_filter(now),
+        {"$set": {"status": "in_review", "reserved_by": token, "reserved_at": now}},
+        return_document=ReturnDocument.AFTER,
+    )
+
+def resolve_reserved_pothole(item_id, token, update):
+    """
+    Applies the reviewer's verdict, but only while they still hold the claim.
+    Returns False if the claim expired and was taken over by someone else.
+    """
+    update.setdefault("$unset", {}).update({"reserved_by": "", "reserved_at": ""})
+    result = potholes_collection.update_one({"_id": ObjectId(item_id), "reserved_by": token}, update)
+    return result.matched_count == 1
 
 st.title("📡 Live Pothole Detection Dashboard")
 
@@ -63,24 +186,16 @@ if st.button("🔄 Refresh Data"):
     get_data_from_db.clear()
     st.rerun()
 
-pothole_data = get_data_from_db()
+pothole_data, verified_data, summary = get_data_from_db()
 
 if pothole_data.empty:
     st.warning("No potholes have been detected yet. Run the main application to start collecting data!")
 else:
     st.header("Overall Summary")
-    
-    verified_data = pothole_data[pothole_data['status'] == 'confirmed']
-    if verified_data.empty:
-        total_verified = 0
-        most_common_sev = "N/A"
-    else:
-        total_verified = len(verified_data)
-        most_common_sev = verified_data['severity'].mode()[0]
 
     col1, col2, col3 = st.columns(3)
-    col1.metric("Total Potholes Confirmed", total_verified)
-    col2.metric("Most Common Severity", most_common_sev)
+    col1.metric("Total Potholes Confirmed", summary["total_confirmed"])
+    col2.metric("Most Common Severity", summary["most_common_severity"])
     last_seen_time = pd.to_datetime(pothole_data['timestamp'].iloc[0]).strftime("%d %b %Y, %I:%M %p")
     col3.metric("Last Seen (Any Status)", last_seen_time)
 
@@ -88,21 +203,40 @@ else:
 
     st.header("Map of Detected Potholes")
     if not verified_data.empty:
-        map_center = [verified_data['latitude'].mean(), verified_data['longitude'].mean()]
+        map_center = summary["centroid"] or [verified_data['latitude'].mean(), verified_data['longitude'].mean()]
         m = folium.Map(location=map_center, zoom_start=14, tiles="CartoDB positron")
         color_map = {'Small': 'green', 'Medium': 'orange', 'Large': 'red'}
 
-        for _, row in verified_data.iterrows():
-            html = f"""
-            <b>Severity:</b> {row['severity']}<br>
-            <img src="{row['image_url']}" width="150">
-            """
-            popup = folium.Popup(html, max_width=200)
-            folium.Marker(
-                location=[row['latitude'], row['longitude']],
-                popup=popup,
-                icon=folium.Icon(color=color_map.get(row['severity'], 'blue'))
-            ).add_to(m)
+        # One GeoJSON layer carrying severity/image as feature properties,
+        # clustered so only the markers in view are drawn. Marker colour is
+        # applied in the browser from the properties, and popup HTML is built
+        # only when a marker is clicked.
+        mappable = verified_data.dropna(subset=['latitude', 'longitude'])
+        features = [
+            {
+                "type": "Feature",
+                "geometry": {"type": "Point", "coordinates": [lon, lat]},
+                "properties": {"severity": sev, "image_url": url, "color": color_map.get(sev, 'blue')},
+            }
+            for lon, lat, sev, url in zip(
+                mappable['longitude'], mappable['latitude'], mappable['severity'], mappable['image_url']
+            )
+        ]
+        popup_js = JsCode("""
+        function (feature, layer) {
+            var p = feature.properties;
+            layer.setStyle({color: p.color, fillColor: p.color});
+            layer.bindPopup(function () {
+                return '<b>Severity:</b> ' + p.severity + '<br><img src="' + p.image_url + '" width="150">';
+            }, {maxWidth: 200});
+        }
+        """)
+        cluster = MarkerCluster().add_to(m)
+        folium.GeoJson(
+            {"type": "FeatureCollection", "features": features},
+            marker=folium.CircleMarker(radius=6, fill=True, fill_opacity=0.8),
+            on_each_feature=popup_js,
+        ).add_to(cluster)
         st_folium(m, width=1200, height=500)
     else:
         st.info("No confirmed potholes to display on the map yet.")
@@ -123,12 +257,35 @@ else:
     st.header("Verification Queue")
 
     if potholes_collection is not None:
-        pothole_to_verify = potholes_collection.find_one({"status": "unverified"})
+        review_token = get_review_token()
+        review_warning = st.session_state.pop("review_warning", None)
+        if review_warning:
+            st.warning(review_warning)
+
+        pothole_to_verify = get_reserved_pothole(review_token)
 
         if not pothole_to_verify:
-            st.success("🎉 No more potholes to verify! Great work.")
+            now = datetime.datetime.now(datetime.UTC)
+            available = potholes_collection.count_documents(claimable_filter(now))
+            held_elsewhere = potholes_collection.count_documents({
+                "status": "in_review",
+                "reserved_at": {"$gte": now - REVIEW_TIMEOUT},
+                "reserved_by": {"$ne": review_token},
+            })
+            if available:
+                st.write(f"{available} potholes are waiting for verification.")
+                if st.button("Review Next Pothole", type="primary"):
+                    if claim_next_pothole(review_token) is None:
+                        st.session_state["review_warning"] = "Another reviewer claimed the last pothole first."
+                    st.rerun()
+            if held_elsewhere:
+                st.info(f"⏳ {held_elsewhere} potholes are being reviewed in other sessions. "
+                        f"Unresolved claims are released after {int(REVIEW_TIMEOUT.total_seconds() // 60)} minutes.")
+            elif not available:
+                st.success("🎉 No more potholes to verify! Great work.")
         else:
             item_id = str(pothole_to_verify['_id'])
+            lost_claim = "Your claim on this pothole expired and another reviewer took it over; your verdict was not saved."
             st.write(f"Verifying Pothole ID: `{item_id}`")
             st.image(pothole_to_verify['image_url'], caption=f"Severity: {pothole_to_verify['severity']}")
 
@@ -136,10 +293,8 @@ else:
             with col1:
                 
                 if st.button("Confirm Pothole", use_container_width=True, type="primary", key=f"confirm_{item_id}"):
-                    potholes_collection.update_one(
-                        {"_id": ObjectId(item_id)},
-                        {"$set": {"status": "confirmed"}}
-                    )
+                    if not resolve_reserved_pothole(item_id, review_token, {"$set": {"status": "confirmed"}}):
+                        st.session_state["review_warning"] = lost_claim
                     get_data_from_db.clear()
                     st.rerun()
             
@@ -153,10 +308,11 @@ else:
                     key=f"reject_{item_id}"
                 )
                 if reject_reason:
-                    potholes_collection.update_one(
-                        {"_id": ObjectId(item_id)},
+                    if not resolve_reserved_pothole(
+                        item_id, review_token,
                         {"$set": {"status": "rejected", "reject_reason": reject_reason}}
-                    )
+                    ):
+                        st.session_state["review_warning"] = lost_claim
                     get_data_from_db.clear()
                     st.rerun()
     else:
@@ -3,9 +3,38 @@ from pymongo import MongoClient
 import certifi
 from dotenv import load_dotenv
 import requests
+from requests.adapters import HTTPAdapter
 from PIL import Image
 import io
 import streamlit as st 
+from concurrent.futures import ThreadPoolExecutor
+
+
+DOWNLOAD_WORKERS = 32
+
+
+def _make_session():
+    """A shared session keeps TLS connections alive across image downloads."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=DOWNLOAD_WORKERS, pool_maxsize=DOWNLOAD_WORKERS)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def _fetch_one(session, pothole):
+    """Downloads one pothole image. Returns (pothole, content), content is None on failure."""
+    try:
+        image_url = pothole["image_url"]
+        response = session.get(image_url)
+    except Exception as e:
+        # Any failure costs only this image; the rest of the export carries on.
+        print(f"Error processing pothole {pothole.get('_id')}: {e}")
+        return pothole, None
+    if response.status_code != 200:
+        print(f"Failed to download image: {image_url}")
+        return pothole, None
+    return pothole, response.content
 
 
 def export_data_for_training(potholes_collection):
@@ -34,42 +63,44 @@ def export_data_for_training(potholes_collection):
     st.write(f"Found {len(confirmed_potholes)} confirmed potholes. Starting export...")
     progress_bar = st.progress(0)
 
-    for i, pothole in enumerate(confirmed_potholes):
-        try:
-            image_url = pothole["image_url"]
-            image_id = str(pothole["_id"])
-            
-            
-            response = requests.get(image_url)
-            if response.status_code != 200:
-                print(f"Failed to download image: {image_url}")
-                continue
-            
-            image = Image.open(io.BytesIO(response.content))
-            img_w, img_h = image.size
-            image_filename = os.path.join(images_path, f"{image_id}.jpg")
-            image.save(image_filename)
-
-            
-            padding = 75 
-            
-            original_box_w = img_w - (2 * padding)
-            original_box_h = img_h - (2 * padding)
-
-            norm_w = original_box_w / img_w
-            norm_h = original_box_h / img_h
-            
-            norm_x_center = 0.5
-            norm_y_center = 0.5
-            
-            label_filename = os.path.join(labels_path, f"{image_id}.txt")
-            with open(label_filename, "w") as f:
-                f.write(f"0 {norm_x_center:.6f} {norm_y_center:.6f} {norm_w:.6f} {norm_h:.6f}\n")
-            
-        except Exception as e:
-            print(f"Error processing pothole {pothole['_id']}: {e}")
-        
-        progress_bar.progress((i + 1) / len(confirmed_potholes))
+    # Downloads are I/O-bound, so they overlap on worker threads; saving
+    # and label writing stay on this thread.
+    with _make_session() as session, ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as ex:
+        downloads = ex.map(lambda p: _fetch_one(session, p), confirmed_potholes)
+        for i, (pothole, content) in enumerate(downloads):
+            try:
+                if content is None:
+                    continue
+                image_id = str(pothole["_id"])
+                
+                # The download is already a JPEG: keep its bytes as-is and read
+                # the size from the header (Image.open doesn't decode pixels).
+                with Image.open(io.BytesIO(content)) as image:
+                    img_w, img_h = image.size
+                image_filename = os.path.join(images_path, f"{image_id}.jpg")
+                with open(image_filename, "wb") as f:
+                    f.write(content)
+
+                
+                padding = 75 
+                
+                original_box_w = img_w - (2 * padding)
+                original_box_h = img_h - (2 * padding)
+
+                norm_w = original_box_w / img_w
+                norm_h = original_box_h / img_h
+                
+                norm_x_center = 0.5
+                norm_y_center = 0.5
+                
+                label_filename = os.path.join(labels_path, f"{image_id}.txt")
+                with open(label_filename, "w") as f:
+                    f.write(f"0 {norm_x_center:.6f} {norm_y_center:.6f} {norm_w:.6f} {norm_h:.6f}\n")
+                
+            except Exception as e:
+                print(f"Error processing pothole {pothole['_id']}: {e}")
+            finally:
+                progress_bar.progress((i + 1) / len(confirmed_potholes))
 
     st.success(f"Export complete! Dataset saved to '{dataset_path}' folder.")
 
@@ -0,0 +1,31 @@
+from ultralytics import YOLO
+
+
+# Must match the batch size and image size used by main.py.
+BATCH_SIZE = 8
+IMGSZ = 640
+
+
+def export_engine():
+    """
+    One-time conversion of 'best.pt' into an FP16 TensorRT engine.
+    main.py loads 'best.engine' automatically when it is present.
+    """
+    print("Loading 'best.pt' for TensorRT export...")
+    model = YOLO('best.pt')
+
+    # A dynamic engine up to BATCH_SIZE lets main.py send full batches as
+    # well as the smaller batch left over at the end of each video.
+    engine_path = model.export(
+        format='engine',
+        half=True,
+        imgsz=IMGSZ,
+        dynamic=True,
+        batch=BATCH_SIZE,
+        workspace=4
+    )
+    print(f"\n✅ Export complete! Engine saved to: {engine_path}")
+
+
+if __name__ == "__main__":
+    export_engine()
@@ -1,20 +1,41 @@
 import os
 import cv2
 import time
+import json
+import shutil
+import hashlib
 import datetime
 import certifi
 import threading
+import itertools
+import numpy as np
+import torch
+import torchvision
 from deep_sort_realtime.deepsort_tracker import DeepSort
-from queue import Queue
-from flask import Flask, request, jsonify, render_template, send_from_directory
+from queue import Queue, Empty
+from flask import Flask, request, jsonify, render_template, send_from_directory, send_file
 from flask_cors import CORS
 from werkzeug.utils import secure_filename
 from ultralytics import YOLO
 from pymongo import MongoClient
+from pymongo.write_concern import WriteConcern
+from pymongo.errors import BulkWriteError
+from gridfs import GridFSBucket
+from gridfs.errors import NoFile
 from dotenv import load_dotenv
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, Future
 
 
+# Concurrency comes from the processing pool; size each worker's OpenCV and
+# PyTorch thread pools so the pool as a whole doesn't oversubscribe the CPUs.
+# With CUDA, inference is GPU-bound and a worker only needs one CPU for decode
+# and tracking; on CPU-only hosts the cores are split across the workers.
+CPU_COUNT = os.cpu_count() or 2
+PROCESSING_WORKERS = max(1, CPU_COUNT // 2)
+THREADS_PER_WORKER = 1 if torch.cuda.is_available() else max(1, CPU_COUNT // PROCESSING_WORKERS)
+cv2.setNumThreads(THREADS_PER_WORKER)
+torch.set_num_threads(THREADS_PER_WORKER)
+
 load_dotenv()
 
 
@@ -24,6 +45,7 @@ if not MONGO_URI:
 client = MongoClient(MONGO_URI, tlsCAFile=certifi.where())
 db = client.pothole_db
 potholes_collection = db.potholes
+image_bucket = GridFSBucket(db, bucket_name="pothole_images")
 print("✅ Successfully connected to MongoDB Atlas.")
 
 
@@ -33,8 +55,52 @@ try:
 except Exception as e:
     print(f"⚠️ Could not create 2dsphere index: {e}")
 
+try:
+    # Serves the dashboard's status-filtered, newest-first queries and its
+    # newest-first data log without collection scans or in-memory sorts.
+    potholes_collection.create_index([("status", 1), ("timestamp", -1)])
+    potholes_collection.create_index([("timestamp", -1)])
+    print("✅ Ensured (status, timestamp) and timestamp indexes exist.")
+except Exception as e:
+    print(f"⚠️ Could not create status/timestamp indexes: {e}")
+
+
+# Detector settings shared by every video job. Batching amortises the
+# per-call launch/preprocessing overhead across several kept frames.
+INFERENCE_DEVICE = 0 if torch.cuda.is_available() else 'cpu'
+USE_HALF = INFERENCE_DEVICE != 'cpu'
+INFERENCE_IMGSZ = 640
+BATCH_SIZE = 8
+
+# Prefer the TensorRT engine built by export_engine.py; fall back to the
+# PyTorch checkpoint when it has not been exported on this machine.
+MODEL_PATH = 'best.engine' if os.path.exists('best.engine') else 'best.pt'
+model = YOLO(MODEL_PATH)
+MODEL_MTIME = os.path.getmtime(MODEL_PATH)
+if MODEL_PATH.endswith('.pt'):
+    model.fuse()
+# Warm up once so the first uploaded video doesn't pay for engine/CUDA setup.
+model(np.zeros((INFERENCE_IMGSZ, INFERENCE_IMGSZ, 3), dtype=np.uint8),
+      imgsz=INFERENCE_IMGSZ, half=USE_HALF, device=INFERENCE_DEVICE, verbose=False)
+print(f"✅ Loaded detection model from '{MODEL_PATH}'.")
+
+# libjpeg-turbo (SIMD DCT/Huffman) for pothole crops; falls back to OpenCV's encoder.
+JPEG_QUALITY = 85
+try:
+    from turbojpeg import TurboJPEG
+    jpeg = TurboJPEG()
+except (ImportError, OSError, RuntimeError) as e:
+    jpeg = None
+    print(f"⚠️ TurboJPEG unavailable, using OpenCV for JPEG encoding: {e}")
+
+# Decode uploads with NVDEC when torchvision was built with GPU video support.
+try:
+    torchvision.set_video_backend("cuda")
+    GPU_DECODE = torch.cuda.is_available()
+except RuntimeError:
+    GPU_DECODE = False
+print(f"✅ Video decoding backend: {'NVDEC (cuda)' if GPU_DECODE else 'OpenCV (cpu)'}.")
 
-model = YOLO('best.pt')
 app = Flask(__name__, template_folder='.', static_folder='.')
 CORS(app)
 
@@ -43,47 +109,113 @@ IMAGE_FOLDER = 'pothole_images'
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(IMAGE_FOLDER, exist_ok=True)
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+IMAGE_CACHE_MAX_AGE = 365 * 24 * 60 * 60
 
 data_queue = Queue()
 
-executor = ThreadPoolExecutor(max_workers=os.cpu_count() or 2)
+# database_worker flushes after this many documents or this many seconds,
+# whichever comes first. Acknowledged writes without waiting on the journal.
+DB_BATCH_SIZE = 100
+DB_FLUSH_INTERVAL = 1.0
+bulk_potholes_collection = potholes_collection.with_options(write_concern=WriteConcern(w=1, j=False))
+
+# Detection results keyed by the SHA-256 of the uploaded video, so a
+# resubmitted video skips decode + detect + track entirely.
+DETECTION_CACHE_DIR = os.path.join('.cache', 'detections')
+DETECTION_CACHE_MAX_BYTES = 64 * 1024 * 1024
+DETECTION_CACHE_MIN_FREE_BYTES = 1024 * 1024 * 1024
+HASH_CHUNK_SIZE = 1024 * 1024
+# Bump whenever the detection, tracking or frame-sampling settings in
+# process_video_and_detect change, so cached results from older settings miss.
+DETECTION_SETTINGS_VERSION = 2
+os.makedirs(DETECTION_CACHE_DIR, exist_ok=True)
+
+executor = ThreadPoolExecutor(max_workers=PROCESSING_WORKERS)
+# Encoding and uploading crops happens here, off the detection loop.
+image_executor = ThreadPoolExecutor(max_workers=4)
+
+# Image names are a per-process start-time prefix plus a monotonic counter,
+# so saving a crop needs no clock reads and names never collide within a run.
+_SAVE_PREFIX = time.strftime("%Y%m%d-%H%M%S")
+_SAVE_SEQ = itertools.count()
 
 
 def database_worker():
-    """Pulls processed data from the queue and saves it to MongoDB."""
+    """
+    Pulls processed data from the queue and saves it to MongoDB, batching
+    documents into one insert per DB_BATCH_SIZE items or DB_FLUSH_INTERVAL seconds.
+    """
+    pending_documents = []
+    last_flush = time.monotonic()
     while True:
-        lat, lon, severity, image_path = data_queue.get()
-        save_to_database_mongo(lat, lon, severity, image_path)
-        data_queue.task_done()
-
-
-def get_pothole_severity(box_coords, frame_shape):
+        try:
+            lat, lon, severity, image = data_queue.get(timeout=DB_FLUSH_INTERVAL)
+        except Empty:
+            pass
+        else:
+            try:
+                # Fresh detections carry the pending upload; cache replays carry the stored name.
+                image_name = image.result() if isinstance(image, Future) else image
+                pending_documents.append(build_pothole_document(lat, lon, severity, image_name))
+            except Exception as e:
+                print(f"❌ Could not save {severity} pothole at ({lat}, {lon}): {e}")
+            finally:
+                data_queue.task_done()
+
+        if pending_documents and (len(pending_documents) >= DB_BATCH_SIZE
+                                  or time.monotonic() - last_flush >= DB_FLUSH_INTERVAL):
+            save_to_database_mongo(pending_documents)
+            pending_documents = []
+            last_flush = time.monotonic()
+
+
+def severities_batch(boxes_xyxy, frame_h, frame_w):
     """
-    Calculates pothole severity by adjusting its pixel area based on its
-    vertical position in the frame to account for perspective.
+    Calculates pothole severity for an (N, 4) array of xyxy boxes by adjusting
+    each pixel area based on its vertical position in the frame to account
+    for perspective. Returns an array of "Small"/"Medium"/"Large".
     """
     PERSPECTIVE_MULTIPLIER = 2.5 
     LARGE_THRESHOLD = 40000
     MEDIUM_THRESHOLD = 15000
-    frame_h, frame_w = frame_shape
-    x1, y1, x2, y2 = box_coords
-    box_w = x2 - x1
-    box_h = y2 - y1
-    pixel_area = box_w * box_h
-    box_bottom_y = y2
+    boxes = np.asarray(boxes_xyxy, dtype=np.float64).reshape(-1, 4)
+    pixel_area = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    box_bottom_y = boxes[:, 3]
     perspective_factor = 1.0 + ((frame_h - box_bottom_y) / frame_h) * PERSPECTIVE_MULTIPLIER
     adjusted_area = pixel_area * perspective_factor
-    
-    if adjusted_area > LARGE_THRESHOLD:
-        return "Large"
-    if adjusted_area > MEDIUM_THRESHOLD:
-        return "Medium"
-    return "Small"
+    return np.where(adjusted_area > LARGE_THRESHOLD, "Large",
+                    np.where(adjusted_area > MEDIUM_THRESHOLD, "Medium", "Small"))
+
+
+def get_pothole_severity(box_coords, frame_shape):
+    """Scalar wrapper around severities_batch for a single box."""
+    frame_h, frame_w = frame_shape
+    return str(severities_batch([box_coords], frame_h, frame_w)[0])
+
+
+def encode_jpeg(image):
+    """Encodes a BGR image to JPEG bytes, using libjpeg-turbo when available."""
+    if jpeg is not None:
+        return jpeg.encode(image, quality=JPEG_QUALITY)
+    success, buf = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY])
+    if not success:
+        raise ValueError("Could not encode pothole image")
+    return buf.tobytes()
+
+
+def upload_pothole_image(pothole_img, image_name):
+    """Encodes a pothole crop and stores it in GridFS. Returns the image name."""
+    image_bucket.upload_from_stream(
+        image_name, encode_jpeg(pothole_img), metadata={"contentType": "image/jpeg"}
+    )
+    return image_name
 
-def save_pothole_image(frame, box_coords):
+
+def crop_pothole(frame, box_coords):
     """
-    Crops the detected pothole with added padding for better context
-    and saves it as a JPEG image.
+    Crops the detected pothole with added padding for better context.
+    The crop is copied so it doesn't keep the full frame alive while it
+    waits to be encoded.
     """
     PADDING_PIXELS = 75 
     frame_h, frame_w, _ = frame.shape
@@ -96,17 +228,21 @@ def save_pothole_image(frame, box_coords):
     safe_y1 = max(0, new_y1)
     safe_x2 = min(frame_w, new_x2)
     safe_y2 = min(frame_h, new_y2)
-    pothole_img = frame[safe_y1:safe_y2, safe_x1:safe_x2]
-    timestamp_str = time.strftime("%Y%m%d-%H%M%S")
-    image_name = f"pothole_{timestamp_str}_{threading.get_ident()}.jpg"
-    image_path = os.path.join(IMAGE_FOLDER, image_name)
-    cv2.imwrite(image_path, pothole_img)
-    return image_path
+    return frame[safe_y1:safe_y2, safe_x1:safe_x2].copy()
+
+
+def save_pothole_image(pothole_img):
+    """
+    Hands an already-cropped pothole image to the image pool for JPEG
+    encoding and upload. Returns a Future that resolves to the stored image name.
+    """
+    image_name = f"pothole_{_SAVE_PREFIX}_{next(_SAVE_SEQ):08d}_{threading.get_ident()}.jpg"
+    return image_executor.submit(upload_pothole_image, pothole_img, image_name)
 
 
-def save_to_database_mongo(lat, lon, severity, image_path):
-    """Constructs and inserts the pothole document into MongoDB."""
-    image_filename = os.path.basename(image_path)
+def build_pothole_document(lat, lon, severity, image_name):
+    """Constructs the MongoDB document for a detected pothole."""
+    image_filename = os.path.basename(image_name)
     
     
     host_url = os.getenv("FLASK_HOST_URL", "http://127.0.0.1:5001")
@@ -119,22 +255,134 @@ def save_to_database_mongo(lat, lon, severity, image_path):
         "timestamp": datetime.datetime.now(datetime.UTC),
         "status": "unverified"
     }
-    potholes_collection.insert_one(pothole_document)
-    print(f"💾 BACKGROUND SAVE: New {severity} pothole at ({lat}, {lon}) saved.")
+    return pothole_document
 
 
-def process_video_and_detect(video_path, latitude, longitude, debug=False):
+def save_to_database_mongo(pothole_documents):
+    """Bulk-inserts a batch of pothole documents into MongoDB."""
+    try:
+        # Unordered, so one bad document doesn't abort the rest of the batch.
+        bulk_potholes_collection.insert_many(pothole_documents, ordered=False)
+        print(f"💾 BACKGROUND SAVE: {len(pothole_documents)} new potholes saved.")
+    except BulkWriteError as e:
+        failed = len(e.details.get("writeErrors", []))
+        print(f"⚠️ BACKGROUND SAVE: {len(pothole_documents) - failed} potholes saved, {failed} failed.")
+    except Exception as e:
+        print(f"❌ BACKGROUND SAVE: Could not save {len(pothole_documents)} potholes: {e}")
+
+
+def save_upload_with_hash(file, video_path):
+    """Streams an uploaded file to disk and returns its SHA-256 hex digest."""
+    digest = hashlib.sha256()
+    with open(video_path, 'wb') as out:
+        for chunk in iter(lambda: file.stream.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+            out.write(chunk)
+    return digest.hexdigest()
+
+
+def detection_cache_key(video_hash):
+    """
+    Cache key for a video's detections: the video content plus the identity of
+    the detector (weights file and its mtime) and the detection settings version.
+    """
+    key = f"{video_hash}:{MODEL_PATH}:{MODEL_MTIME}:{DETECTION_SETTINGS_VERSION}"
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def load_cached_detections(cache_key):
+    """Returns the cached [(severity, image_name), ...] for a video, or None on a miss."""
+    cache_path = os.path.join(DETECTION_CACHE_DIR, f"{cache_key}.json")
+    try:
+        with open(cache_path) as f:
+            return [tuple(item) for item in json.load(f)]
+    except (OSError, ValueError):
+        return None
+
+
+def store_cached_detections(cache_key, detections):
+    """Writes a video's detections to the cache, evicting the oldest entries to stay bounded."""
+    cache_path = os.path.join(DETECTION_CACHE_DIR, f"{cache_key}.json")
+    tmp_path = f"{cache_path}.tmp"
+    try:
+        with open(tmp_path, 'w') as f:
+            json.dump(detections, f)
+        os.replace(tmp_path, cache_path)
+
+        entries = sorted(
+            (e for e in os.scandir(DETECTION_CACHE_DIR) if e.name.endswith('.json')),
+            key=lambda e: e.stat().st_mtime
+        )
+        total_bytes = sum(e.stat().st_size for e in entries)
+        for entry in entries[:-1]:
+            if (total_bytes <= DETECTION_CACHE_MAX_BYTES
+                    and shutil.disk_usage(DETECTION_CACHE_DIR).free >= DETECTION_CACHE_MIN_FREE_BYTES):
+                break
+            total_bytes -= entry.stat().st_size
+            os.remove(entry.path)
+    except OSError as e:
+        print(f"⚠️ Could not update detection cache: {e}")
+
+
+def read_kept_frames(cap, video_path, stride):
+    """
+    Yields (frame_index, BGR frame) for every `stride`-th frame of the video.
+    With NVDEC the whole stream is decoded on the GPU and only kept frames
+    are copied back to host memory; otherwise OpenCV grabs (demuxes) every
+    frame but only decodes the kept ones.
+    """
+    # If NVDEC can't handle this video (codec/profile), fall back to OpenCV and
+    # resume from the first frame that wasn't yielded yet.
+    next_index = 0
+    if GPU_DECODE:
+        try:
+            reader = torchvision.io.VideoReader(video_path, "video")
+            for frame_index, frame_dict in enumerate(reader):
+                if frame_index % stride == 0:
+                    frame = frame_dict['data']
+                    if frame.shape[0] == 3:
+                        frame = frame.permute(1, 2, 0)
+                    # RGB -> BGR on the device, then a single download for the tracker and crops.
+                    yield frame_index, frame.flip(-1).contiguous().cpu().numpy()
+                next_index = frame_index + 1
+            return
+        except Exception as e:
+            print(f"⚠️ NVDEC decoding failed for {video_path} at frame {next_index}, "
+                  f"falling back to OpenCV: {e}")
+
+    frame_index = 0
+    while cap.grab():
+        if frame_index >= next_index and frame_index % stride == 0:
+            success, frame = cap.retrieve()
+            if not success:
+                break
+            yield frame_index, frame
+        frame_index += 1
+
+
+def process_video_and_detect(video_path, latitude, longitude, debug=False, video_hash=None):
     """
     Main video processing function with a finely-tuned object tracker
     that prioritizes motion (IoU) over appearance to handle perspective changes.
+    When `video_hash` is given, cached detections for the same video are replayed.
     """
+    cache_key = detection_cache_key(video_hash) if video_hash else None
+    if cache_key and not debug:
+        cached = load_cached_detections(cache_key)
+        if cached is not None:
+            for severity, image_name in cached:
+                data_queue.put((latitude, longitude, severity, image_name))
+            print(f"♻️  Cache hit for {video_path}: replayed {len(cached)} potholes.")
+            return
     
     CONFIDENCE_THRESHOLD = 0.6
     
     MIN_BOX_WIDTH = 20
     MIN_BOX_HEIGHT = 20
     
-    FRAME_SKIP = 3
+    # Road potholes don't need every frame; sample at roughly this rate
+    # whatever the source frame rate is.
+    TARGET_HZ = 5
 
     
     tracker = DeepSort(
@@ -158,34 +406,38 @@ def process_video_and_detect(video_path, latitude, longitude, debug=False):
     
     if fps == 0:
         fps = 30 
-    frame_count = 0
+    stride = max(1, int(round(fps / TARGET_HZ)))
     saved_pothole_ids = set()
+    new_detections = []
 
     output_video = None
     if debug:
         fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-        output_video = cv2.VideoWriter('debug_output.mp4', fourcc, fps / FRAME_SKIP, (frame_w, frame_h))
+        output_video = cv2.VideoWriter('debug_output.mp4', fourcc, fps / stride, (frame_w, frame_h))
         print("🕵️  DEBUG MODE: An output video named 'debug_output.mp4' will be created.")
 
-    print(f"🚀 Starting detection with FINAL tracking on {video_path}...")
-    while True:
-        success, frame = cap.read()
-        if not success:
-            break
-
-        if frame_count % FRAME_SKIP == 0:
-            results = model(frame)
+    def process_batch(batch):
+        """Runs one batched forward pass, then feeds each frame to the tracker in order."""
+        results = model(
+            [f for _, f in batch],
+            imgsz=INFERENCE_IMGSZ,
+            half=USE_HALF,
+            device=INFERENCE_DEVICE,
+            verbose=False
+        )
+        # DeepSort keeps temporal state, so tracks must be updated frame by frame.
+        for (_, frame), result in zip(batch, results):
             detections = []
-            for result in results:
-                for box in result.boxes:
-                    if box.conf[0] > CONFIDENCE_THRESHOLD:
-                        x1, y1, x2, y2 = map(int, box.xyxy[0])
-                        w, h = x2 - x1, y2 - y1
-                        if w > MIN_BOX_WIDTH and h > MIN_BOX_HEIGHT:
-                            detections.append(([x1, y1, w, h], box.conf[0], int(box.cls[0])))
+            for box in result.boxes:
+                if box.conf[0] > CONFIDENCE_THRESHOLD:
+                    x1, y1, x2, y2 = map(int, box.xyxy[0])
+                    w, h = x2 - x1, y2 - y1
+                    if w > MIN_BOX_WIDTH and h > MIN_BOX_HEIGHT:
+                        detections.append(([x1, y1, w, h], box.conf[0], int(box.cls[0])))
 
             tracks = tracker.update_tracks(detections, frame=frame)
 
+            new_tracks = []
             for track in tracks:
                 if not track.is_confirmed():
                     continue
@@ -200,20 +452,42 @@ def process_video_and_detect(video_path, latitude, longitude, debug=False):
                                 cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 255, 0), 2)
 
                 if track_id not in saved_pothole_ids:
-                    severity = get_pothole_severity((x1, y1, x2, y2), (frame_h, frame_w))
-                    image_path = save_pothole_image(frame, (x1, y1, x2, y2))
-                    data_queue.put((latitude, longitude, severity, image_path))
+                    new_tracks.append((track_id, (x1, y1, x2, y2)))
+
+            if new_tracks:
+                severities = severities_batch([box for _, box in new_tracks], frame_h, frame_w)
+                for (track_id, box), severity in zip(new_tracks, severities):
+                    severity = str(severity)
+                    roi = crop_pothole(frame, box)
+                    image_future = save_pothole_image(roi)
+                    data_queue.put((latitude, longitude, severity, image_future))
+                    new_detections.append((severity, image_future))
                     print(f"✅ New pothole detected! ID: {track_id}, Severity: {severity}.")
                     saved_pothole_ids.add(track_id)
 
             if debug and output_video:
                 output_video.write(frame)
 
-        frame_count += 1
+    print(f"🚀 Starting detection with FINAL tracking on {video_path}...")
+    pending = []
+    for frame_count, frame in read_kept_frames(cap, video_path, stride):
+        pending.append((frame_count, frame))
+        if len(pending) == BATCH_SIZE:
+            process_batch(pending)
+            pending = []
+
+    # Drain the final, partially filled batch.
+    if pending:
+        process_batch(pending)
 
     cap.release()
     if debug and output_video:
         output_video.release()
+    if cache_key:
+        try:
+            store_cached_detections(cache_key, [(sev, f.result()) for sev, f in new_detections])
+        except Exception as e:
+            print(f"⚠️ Not caching detections for {video_path}, an image upload failed: {e}")
     print(f"🏁 Finished processing video: {video_path}. Found {len(saved_pothole_ids)} unique potholes.")
 @app.route('/')
 def index():
@@ -238,10 +512,10 @@ def handle_report():
 
     filename = secure_filename(file.filename)
     video_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-    file.save(video_path)
+    video_hash = save_upload_with_hash(file, video_path)
     
     # NEW WAY
-    executor.submit(process_video_and_detect, video_path, latitude, longitude, debug=False)
+    executor.submit(process_video_and_detect, video_path, latitude, longitude, debug=False, video_hash=video_hash)
     
     print(f"📥 Received report. Submitted {filename} to the processing pool.")
     return jsonify({
@@ -251,8 +525,23 @@ def handle_report():
 
 @app.route('/images/<path:filename>')
 def get_image(filename):
-    """Serves a detected pothole image from the image folder."""
-    return send_from_directory(IMAGE_FOLDER, filename)
+    """Serves a detected pothole image from GridFS, falling back to the legacy image folder."""
+    try:
+        grid_out = image_bucket.open_download_stream_by_name(filename)
+    except NoFile:
+        return send_from_directory(IMAGE_FOLDER, filename)
+    # Image names are unique and never rewritten, so let browsers cache them
+    # for good and revalidate against the GridFS file id.
+    response = send_file(
+        grid_out,
+        mimetype="image/jpeg",
+        download_name=filename,
+        etag=str(grid_out._id),
+        last_modified=grid_out.upload_date,
+        max_age=IMAGE_CACHE_MAX_AGE
+    )
+    response.content_length = grid_out.length
+    return response
 
 
 if __name__ == "__main__":
@@ -1,4 +1,5 @@
 from ultralytics import YOLO
+import torch
 import yaml
 import os
 
@@ -13,8 +14,22 @@ DATASET_CONFIG = {
     }
 }
 
-with open('pothole_retrain_config.yaml', 'w') as f:
-    yaml.dump(DATASET_CONFIG, f)
+CONFIG_PATH = 'pothole_retrain_config.yaml'
+
+
+def ensure_dataset_config():
+    """Writes the dataset YAML only when it is missing or out of date."""
+    try:
+        with open(CONFIG_PATH) as f:
+            if yaml.safe_load(f) == DATASET_CONFIG:
+                return
+    except (OSError, yaml.YAMLError):
+        pass
+    with open(CONFIG_PATH, 'w') as f:
+        yaml.dump(DATASET_CONFIG, f)
+
+
+ensure_dataset_config()
 
 def train_model():
     """
@@ -28,11 +43,18 @@ def train_model():
     print("Starting fine-tuning process...")
     
     
+    # The exported dataset is small, so caching it in RAM removes disk I/O
+    # on every epoch; AMP trains in mixed precision on the GPU.
     results = model.train(
-        data='pothole_retrain_config.yaml',
+        data=CONFIG_PATH,
         epochs=50, 
         imgsz=640,
-        name='pothole_finetune_v2'
+        name='pothole_finetune_v2',
+        cache='ram',
+        amp=True,
+        workers=min(8, os.cpu_count() or 1),
+        cos_lr=True,
+        device=0 if torch.cuda.is_available() else 'cpu'
     )
     
     print("\n✅ Training complete! New model saved.")